@@ -0,0 +1,28 @@
+import os
+import sys
+
+from dotenv import load_dotenv
+
+# Gunicorn config:
+#   gunicorn -c gunicorn.conf.py main:sio_app
+load_dotenv()
+
+bind = f"{os.getenv('HOST', '0.0.0.0')}:{os.getenv('PORT', 3000)}"
+worker_class = 'uvicorn.workers.UvicornWorker'
+graceful_timeout = 30
+
+# Several workers need Redis (shared cache, Socket.IO rooms and the bot owner lock)
+# and either a sticky load balancer or websocket-only Socket.IO clients, since
+# long-polling requests must reach the worker that did the handshake
+workers = int(os.getenv('WEB_CONCURRENCY', 1))
+if workers > 1:
+    sticky = os.getenv('STICKY_SESSIONS', 'false').lower() == 'true'
+    transports = [t.strip() for t in os.getenv('SOCKETIO_TRANSPORTS', '').split(',') if t.strip()]
+    websocket_only = transports == ['websocket']
+    if not os.getenv('REDIS_URL') or not (sticky or websocket_only):
+        print(
+            "WEB_CONCURRENCY > 1 needs REDIS_URL and either STICKY_SESSIONS=true "
+            "or SOCKETIO_TRANSPORTS=websocket, running a single worker",
+            file=sys.stderr
+        )
+        workers = 1
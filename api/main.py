@@ -4,18 +4,24 @@ import logging
 import time
 import signal
 import sys
-from datetime import datetime
-from typing import Dict, Any, Optional
+import uuid
+from collections import OrderedDict, defaultdict
+from datetime import datetime, timezone
+from typing import Dict, Any, Optional, Tuple
 
 import uvicorn
-from fastapi import FastAPI, HTTPException
+from fastapi import APIRouter, FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse, Response
 import socketio
 import discord
 from discord.ext import commands
 import redis.asyncio as redis
+from cachetools import TLRUCache, TTLCache
 from dotenv import load_dotenv
-import json
+import orjson
+import xxhash
+import zstandard as zstd
 
 # Load environment variables
 load_dotenv()
@@ -38,47 +44,185 @@ class Config:
     CORS_ORIGIN = os.getenv('CORS_ORIGIN', '*')
     API_VERSION = os.getenv('API_VERSION', 'v1')
     DISABLE_DISCORD_BOT = os.getenv('DISABLE_DISCORD_BOT', 'false').lower() == 'true'
+    BOT_LOCK_TTL = int(os.getenv('BOT_LOCK_TTL', 30))
+    SOCKETIO_TRANSPORTS = [t.strip() for t in os.getenv('SOCKETIO_TRANSPORTS', 'polling,websocket').split(',') if t.strip()]
+    PRESENCE_HASH_MAX = int(os.getenv('PRESENCE_HASH_MAX', 100_000))
+    PRESENCE_FLUSH_INTERVAL = float(os.getenv('PRESENCE_FLUSH_INTERVAL', 0.25))
+    REST_CONCURRENCY = int(os.getenv('REST_CONCURRENCY', 20))
+    MEMORY_CACHE_MAX = int(os.getenv('MEMORY_CACHE_MAX', 50_000))
+    L1_CACHE_MAX = int(os.getenv('L1_CACHE_MAX', 10_000))
+    L1_CACHE_TTL = float(os.getenv('L1_CACHE_TTL', 5))
+    REDIS_FLUSH_INTERVAL = float(os.getenv('REDIS_FLUSH_INTERVAL', 0.005))
+    REDIS_PIPELINE_MAX = int(os.getenv('REDIS_PIPELINE_MAX', 100))
 
 config = Config()
 
+# Redis values are zstd-compressed JSON behind a one-byte format tag;
+# untagged values are plain JSON written by older versions
+_CACHE_FORMAT_ZSTD = b'\x01'
+_CCTX = zstd.ZstdCompressor(level=3)
+_DCTX = zstd.ZstdDecompressor()
+
+def _encode_cache_value(data: Dict[str, Any]) -> bytes:
+    return _CACHE_FORMAT_ZSTD + _CCTX.compress(orjson.dumps(data, default=str))
+
+def _decode_cache_value(raw: bytes) -> Dict[str, Any]:
+    if raw[:1] == _CACHE_FORMAT_ZSTD:
+        return orjson.loads(_DCTX.decompress(raw[1:]))
+    return orjson.loads(raw)
+
 # Simple cache system
 class SimpleCache:
     def __init__(self):
         self.redis_client = None
-        self.memory_cache = {}
-        self.cache_ttl = 300  # 5 minutes
+        self.cache_ttl = 300  # 5 minutes, for keys without a prefix TTL
+        # Profiles rarely change; presence is rewritten on every update
+        self.prefix_ttls = {b'user': 3600, b'presence': 30}
+        self.memory_cache = TLRUCache(
+            maxsize=config.MEMORY_CACHE_MAX,
+            ttu=lambda key, value, now: now + self.ttl_for(key)
+        )
+        # Short-lived local copy of Redis reads, invalidated via Pub/Sub
+        self.l1 = TTLCache(maxsize=config.L1_CACHE_MAX, ttl=config.L1_CACHE_TTL)
+        self.invalidate_channel = 'cache:invalidate'
+        self._invalidation_task = None
+        # L1 is only used while the invalidation listener is subscribed
+        self._l1_enabled = False
+        # Pending writes, flushed to Redis in pipelined batches
+        self._write_queue = asyncio.Queue()
+        self._writer_task = None
         
+    # Cache keys are (kind, user_id) tuples in process and b"kind:user_id" in Redis
+    def ttl_for(self, key: Tuple[bytes, int]) -> int:
+        return self.prefix_ttls.get(key[0], self.cache_ttl)
+    
     async def connect_redis(self):
         if config.REDIS_URL:
             try:
                 self.redis_client = redis.from_url(config.REDIS_URL)
                 await self.redis_client.ping()
+                self._invalidation_task = asyncio.create_task(self._listen_invalidations())
+                self._writer_task = asyncio.create_task(self._flush_writes())
                 logger.info("Redis connected")
             except Exception as e:
                 logger.warning(f"Redis failed, using memory cache: {e}")
                 self.redis_client = None
     
-    async def set_cache(self, key: str, data: Dict[str, Any]):
+    async def _listen_invalidations(self):
+        """Drop L1 entries whenever any worker rewrites the key in Redis"""
+        delay = 1
+        while True:
+            pubsub = self.redis_client.pubsub()
+            try:
+                await pubsub.subscribe(self.invalidate_channel)
+                self._l1_enabled = True
+                delay = 1
+                async for message in pubsub.listen():
+                    if message['type'] != 'message':
+                        continue
+                    try:
+                        kind, _, user_id = message['data'].partition(b':')
+                        self.l1.pop((kind, int(user_id)), None)
+                    except (AttributeError, ValueError):
+                        logger.debug(f"Ignoring invalidation message: {message['data']!r}")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning(f"Cache invalidation listener lost, retrying in {delay}s: {e}")
+            finally:
+                # Without invalidations L1 could serve stale data, bypass it until resubscribed
+                self._l1_enabled = False
+                self.l1.clear()
+                try:
+                    await pubsub.close()
+                except Exception:
+                    pass
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 30)
+    
+    async def _flush_writes(self):
+        """Drain queued writes into one pipelined round-trip per batch"""
+        while True:
+            batch = [await self._write_queue.get()]
+            if self._write_queue.qsize() < config.REDIS_PIPELINE_MAX:
+                await asyncio.sleep(config.REDIS_FLUSH_INTERVAL)
+            while len(batch) < config.REDIS_PIPELINE_MAX and not self._write_queue.empty():
+                batch.append(self._write_queue.get_nowait())
+            
+            # close() queues None as a stop marker; flush everything left and exit
+            if None in batch:
+                batch = [write for write in batch if write is not None]
+                while not self._write_queue.empty():
+                    batch.append(self._write_queue.get_nowait())
+                if batch:
+                    await self._write_batch(batch)
+                return
+            await self._write_batch(batch)
+    
+    async def _write_batch(self, batch):
+        try:
+            async with self.redis_client.pipeline(transaction=False) as pipe:
+                for key, data in batch:
+                    redis_key = b'%s:%d' % key
+                    if data is None:
+                        pipe.delete(redis_key)
+                    else:
+                        pipe.setex(redis_key, self.ttl_for(key), _encode_cache_value(data))
+                    pipe.publish(self.invalidate_channel, redis_key)
+                await pipe.execute()
+        except Exception as e:
+            logger.warning(f"Redis pipeline failed, dropped {len(batch)} writes: {e}")
+    
+    async def close(self):
+        if self._writer_task:
+            # Let the writer flush its current batch and the queue before the connection goes away
+            self._write_queue.put_nowait(None)
+            try:
+                await asyncio.wait_for(self._writer_task, timeout=10)
+            except Exception as e:
+                logger.warning(f"Redis writer did not finish flushing: {e}")
+            self._writer_task = None
+        if self._invalidation_task:
+            self._invalidation_task.cancel()
+            self._invalidation_task = None
         if self.redis_client:
-            await self.redis_client.setex(key, self.cache_ttl, json.dumps(data))
+            await self.redis_client.close()
+            self.redis_client = None
+    
+    async def set_cache(self, kind: bytes, user_id: int, data: Dict[str, Any]):
+        key = (kind, user_id)
+        if self.redis_client:
+            # Serve our own write from L1 until the pipeline lands it in Redis
+            if self._l1_enabled:
+                self.l1[key] = data
+            self._write_queue.put_nowait((key, data))
         else:
-            self.memory_cache[key] = {
-                'data': data,
-                'timestamp': time.time()
-            }
+            self.memory_cache[key] = data
     
-    async def get_cache(self, key: str) -> Optional[Dict[str, Any]]:
+    async def delete_cache(self, kind: bytes, user_id: int):
+        key = (kind, user_id)
         if self.redis_client:
-            data = await self.redis_client.get(key)
-            return json.loads(data) if data else None
+            self.l1.pop(key, None)
+            # Queued behind any pending write for the same key
+            self._write_queue.put_nowait((key, None))
         else:
-            cached = self.memory_cache.get(key)
-            if cached:
-                if time.time() - cached['timestamp'] < self.cache_ttl:
-                    return cached['data']
-                else:
-                    del self.memory_cache[key]
-            return None
+            self.memory_cache.pop(key, None)
+    
+    async def get_cache(self, kind: bytes, user_id: int) -> Optional[Dict[str, Any]]:
+        key = (kind, user_id)
+        if self.redis_client:
+            cached = self.l1.get(key) if self._l1_enabled else None
+            if cached is not None:
+                return cached
+            data = await self.redis_client.get(b'%s:%d' % key)
+            if not data:
+                return None
+            cached = _decode_cache_value(data)
+            if self._l1_enabled:
+                self.l1[key] = cached
+            return cached
+        else:
+            return self.memory_cache.get(key)
 
 cache = SimpleCache()
 
@@ -100,11 +244,128 @@ async def graceful_shutdown():
     
     # Close Redis connection
     if cache.redis_client:
-        await cache.redis_client.close()
+        await cache.close()
         logger.info("Redis connection closed")
     
     logger.info("Graceful shutdown complete")
 
+# Serialization helpers
+_ACTIVITY_ATTRS = ('details', 'state', 'flags', 'created_at', 'sync_id', 'session_id')
+_ASSET_KEYS = ('large_image', 'large_text', 'small_image', 'small_text')
+
+def _activity_timestamp(activity, attr: str) -> Optional[float]:
+    """Read an activity's start/end as epoch seconds (discord.Spotify raises KeyError when unset)"""
+    try:
+        value = getattr(activity, attr, None)
+    except KeyError:
+        return None
+    return value.timestamp() if value else None
+
+def _serialize_activity(activity) -> Dict[str, Any]:
+    """Build the Lanyard-style dict for a single activity, skipping empty fields"""
+    activity_data = {
+        'type': activity.type.value,
+        'name': activity.name
+    }
+    for attr in _ACTIVITY_ATTRS:
+        value = getattr(activity, attr, None)
+        if value is not None:
+            activity_data[attr] = value
+    
+    application_id = getattr(activity, 'application_id', None)
+    if application_id:
+        activity_data['application_id'] = str(application_id)
+    
+    activity_id = getattr(activity, 'id', None)
+    if activity_id:
+        activity_data['id'] = str(activity_id)
+    
+    # discord.py keeps party/assets as raw gateway dicts
+    party = getattr(activity, 'party', None)
+    if party:
+        size = party.get('size') or (None, None)
+        activity_data['party'] = {
+            'id': party.get('id'),
+            'size': size[0],
+            'max': size[1]
+        }
+    
+    assets = getattr(activity, 'assets', None)
+    if assets:
+        activity_data['assets'] = {k: assets.get(k) for k in _ASSET_KEYS}
+    
+    start = _activity_timestamp(activity, 'start')
+    end = _activity_timestamp(activity, 'end')
+    if start or end:
+        activity_data['timestamps'] = {
+            'start': start,
+            'end': end
+        }
+    
+    return activity_data
+
+def _serialize_user(user) -> Dict[str, Any]:
+    """Build the Lanyard-style discord_user dict for a user or member"""
+    return {
+        'id': str(user.id),
+        'username': user.name,
+        'global_name': getattr(user, 'global_name', None) or user.display_name,
+        'display_name': user.display_name,
+        'avatar': str(user.avatar) if user.avatar else None,
+        'discriminator': user.discriminator,
+        'public_flags': user.public_flags.value if user.public_flags else 0,
+        'banner': str(user.banner) if user.banner else None,
+        'accent_color': user.accent_color.value if user.accent_color else None,
+        'bot': user.bot,
+        'avatar_decoration_data': getattr(user, 'avatar_decoration_data', None),
+        'collectibles': getattr(user, 'collectibles', None),
+        'primary_guild': getattr(user, 'primary_guild', None),
+        'display_name_styles': getattr(user, 'display_name_styles', None)
+    }
+
+def _build_presence_dict(member) -> Dict[str, Any]:
+    """Build the Lanyard-style presence dict for a member (sync, safe for to_thread)"""
+    spotify_activity = next((a for a in member.activities if isinstance(a, discord.Spotify)), None)
+    presence_data = {
+        'userId': str(member.id),
+        'discord_status': str(member.status),
+        'active_on_discord_desktop': member.desktop_status != discord.Status.offline,
+        'active_on_discord_mobile': member.mobile_status != discord.Status.offline,
+        'active_on_discord_web': member.web_status != discord.Status.offline,
+        'active_on_discord_embedded': False,
+        'listening_to_spotify': spotify_activity is not None,
+        'activities': [_serialize_activity(a) for a in member.activities],
+        'spotify': None
+    }
+    
+    # Handle Spotify
+    if spotify_activity:
+        # discord.Spotify exposes the track fields and album art directly
+        presence_data['spotify'] = {
+            'track_id': spotify_activity.track_id,
+            'timestamps': {
+                'start': _activity_timestamp(spotify_activity, 'start'),
+                'end': _activity_timestamp(spotify_activity, 'end')
+            },
+            'song': spotify_activity.title,
+            'artist': spotify_activity.artist,
+            'album_art_url': spotify_activity.album_cover_url or None,
+            'album': spotify_activity.album or None
+        }
+    
+    return presence_data
+
+def _build_presence_dicts(members) -> list:
+    """Build presence dicts for a batch in one to_thread hop (None where a member fails)"""
+    presences = []
+    for member in members:
+        try:
+            presences.append(_build_presence_dict(member))
+        except Exception as e:
+            logger.error(f"Failed to build presence for {member.id}: {e}")
+            presences.append(None)
+    return presences
+
 # Discord bot
 class DiscordBot(commands.Bot):
     def __init__(self):
@@ -120,97 +381,269 @@ class DiscordBot(commands.Bot):
         )
         self.sio = None
         self.ready = False
+        # Logged in for REST calls; the gateway may be connected in another worker
+        self.rest_ready = False
+        # (fingerprint, monotonic write time) of the last presence sent per user, to drop no-op updates
+        self._last_hash: OrderedDict = OrderedDict()
+        # Latest member per user awaiting the next presence flush
+        self._pending_presence: Dict[int, discord.Member] = {}
+        self._presence_flush_task = None
+        # Reverse index of user_id -> guild_ids the bot shares with them
+        self.user_guilds: Dict[int, set] = defaultdict(set)
+        # True once every guild's member list is chunked into the index
+        self.index_complete = False
+        # Encoded /guilds response, rebuilt after any guild change
+        self.guilds_cache: Optional[bytes] = None
+        self.guilds_data: Optional[Dict[str, Any]] = None
+        # Monotonic time the guild list was last written to the shared cache (0 = pending)
+        self._guilds_shared_at = 0.0
+        # In-flight fetch_user calls, shared by concurrent requests
+        self._user_fetches: Dict[int, asyncio.Task] = {}
+        # Caps concurrent REST lookups so fan-outs stay under Discord's rate limits
+        self._rest_semaphore = asyncio.Semaphore(config.REST_CONCURRENCY)
+    
+    async def setup_hook(self):
+        if not self._presence_flush_task or self._presence_flush_task.done():
+            self._presence_flush_task = asyncio.create_task(self._flush_presence_updates())
     
     async def on_ready(self):
         self.ready = True
         logger.info(f"Bot online: {self.user}")
         logger.info(f"In {len(self.guilds)} servers")
+        self.guilds_cache = None
+        
+        self.user_guilds.clear()
+        online = {}
+        for guild in self.guilds:
+            for member in guild.members:
+                self.user_guilds[member.id].add(guild.id)
+                if member.status != discord.Status.offline or member.activities:
+                    online[member.id] = member
+        self.index_complete = all(guild.chunked for guild in self.guilds)
+        logger.info(f"Indexed {len(self.user_guilds)} members")
+        
+        # Warm the presence cache from the member cache; writes are pipelined
+        presences = await asyncio.to_thread(_build_presence_dicts, list(online.values()))
+        now = time.time()
+        for user_id, presence_data in zip(online, presences):
+            if presence_data is None:
+                continue
+            presence_data['lastSeen'] = now
+            await cache.set_cache(b'presence', user_id, presence_data)
+        logger.info(f"Cached presence for {len(presences)} online members")
+    
+    def build_guilds_cache(self) -> Dict[str, Any]:
+        guilds_data = []
+        for guild in self.guilds:
+            guild_data = {
+                'id': str(guild.id),
+                'name': guild.name,
+                'icon': str(guild.icon) if guild.icon else None,
+                'memberCount': guild.member_count,
+                'ownerId': str(guild.owner_id) if guild.owner else None,
+                'features': list(guild.features)
+            }
+            guilds_data.append(guild_data)
+        
+        self.guilds_data = {
+            'guilds': guilds_data,
+            'total': len(guilds_data)
+        }
+        self.guilds_cache = orjson.dumps({
+            "success": True,
+            "data": self.guilds_data
+        })
+        self._guilds_shared_at = 0.0
+        return self.guilds_data
+    
+    async def share_guilds(self):
+        """Write the guild list to the shared cache when it changed or is half way to expiry"""
+        if self.guilds_cache is None:
+            self.build_guilds_cache()
+        elif time.monotonic() - self._guilds_shared_at < cache.ttl_for((b'guilds', 0)) / 2:
+            return
+        await cache.set_cache(b'guilds', 0, self.guilds_data)
+        self._guilds_shared_at = time.monotonic()
+    
+    async def on_member_join(self, member):
+        self.user_guilds[member.id].add(member.guild.id)
+        self.guilds_cache = None  # memberCount changed
+    
+    async def on_member_remove(self, member):
+        self.guilds_cache = None
+        await self._drop_membership(member.id, member.guild.id)
+    
+    async def on_guild_join(self, guild):
+        self.guilds_cache = None
+        # guild_join is dispatched after chunking, so the member list is populated
+        for member in guild.members:
+            self.user_guilds[member.id].add(guild.id)
+        if not guild.chunked:
+            self.index_complete = False
+    
+    async def on_guild_update(self, before, after):
+        self.guilds_cache = None
+    
+    async def on_guild_remove(self, guild):
+        self.guilds_cache = None
+        for member in guild.members:
+            await self._drop_membership(member.id, guild.id)
+    
+    async def _drop_membership(self, user_id: int, guild_id: int):
+        guild_ids = self.user_guilds.get(user_id)
+        if guild_ids:
+            guild_ids.discard(guild_id)
+            if guild_ids:
+                return
+            del self.user_guilds[user_id]
+        
+        # No shared guild left, so the cached presence would only go stale
+        self._last_hash.pop(user_id, None)
+        self._pending_presence.pop(user_id, None)
+        await cache.delete_cache(b'presence', user_id)
+    
+    async def _rest(self, func, *args):
+        """Run a REST call under the shared concurrency limit"""
+        async with self._rest_semaphore:
+            return await func(*args)
+    
+    async def fetch_user_once(self, user_id: int) -> discord.User:
+        """fetch_user, but concurrent callers for the same ID share one REST call"""
+        task = self._user_fetches.get(user_id)
+        if task is None:
+            task = asyncio.create_task(self._rest(self.fetch_user, user_id))
+            self._user_fetches[user_id] = task
+            task.add_done_callback(lambda _: self._user_fetches.pop(user_id, None))
+        # Shield so one cancelled request doesn't cancel the others' fetch
+        return await asyncio.shield(task)
+    
+    def get_cached_member(self, user_id: int) -> Optional[discord.Member]:
+        """Look a member up in the member cache via the reverse index"""
+        for guild_id in self.user_guilds.get(user_id, ()):
+            guild = self.get_guild(guild_id)
+            member = guild.get_member(user_id) if guild else None
+            if member:
+                return member
+        return None
+    
+    async def find_member(self, user_id: int) -> Optional[discord.Member]:
+        """Resolve a member from the member cache, falling back to REST"""
+        member = self.get_cached_member(user_id)
+        if member:
+            return member
+        
+        guild_ids = self.user_guilds.get(user_id)
+        if guild_ids:
+            # Member cache is behind the index, ask the one guild we know about
+            guild = self.get_guild(next(iter(guild_ids)))
+            if guild:
+                try:
+                    return await self._rest(guild.fetch_member, user_id)
+                except (discord.NotFound, discord.Forbidden):
+                    pass
+            return None
+        
+        # A complete index means the user shares no guild with the bot
+        if self.index_complete:
+            return None
+        
+        # Member lists not chunked, query every guild concurrently and keep the first hit
+        tasks = [asyncio.create_task(self._rest(guild.fetch_member, user_id)) for guild in self.guilds]
+        try:
+            for fut in asyncio.as_completed(tasks):
+                try:
+                    return await fut
+                except (discord.NotFound, discord.Forbidden):
+                    continue
+        finally:
+            for task in tasks:
+                task.cancel()
+        return None
     
     async def on_presence_update(self, before, after):
         if not after or not after.id:
             return
-            
-        presence_data = {
-            'userId': str(after.id),
-            'discord_status': str(after.status),
-            'activities': [],
-            'lastSeen': time.time()
-        }
         
-        # Format activities
-        for activity in after.activities:
-            activity_data = {
-                'type': activity.type.value,
-                'name': activity.name,
-                'details': getattr(activity, 'details', None),
-                'state': getattr(activity, 'state', None),
-                'application_id': str(activity.application_id) if activity.application_id else None,
-                'id': str(activity.id) if activity.id else None,
-                'flags': getattr(activity, 'flags', 0),
-                'created_at': getattr(activity, 'created_at', None),
-                'sync_id': getattr(activity, 'sync_id', None),
-                'session_id': getattr(activity, 'session_id', None)
-            }
-            
-            # Add party info if available
-            if hasattr(activity, 'party') and activity.party:
-                activity_data['party'] = {
-                    'id': activity.party.id if activity.party.id else None,
-                    'size': getattr(activity.party, 'size', None),
-                    'max': getattr(activity.party, 'max', None)
-                }
-            
-            if activity.assets:
-                activity_data['assets'] = {
-                    'large_image': activity.assets.large_image,
-                    'large_text': activity.assets.large_text,
-                    'small_image': activity.assets.small_image,
-                    'small_text': activity.assets.small_text
-                }
-            
-            if activity.timestamps:
-                activity_data['timestamps'] = {
-                    'start': activity.timestamps.start.timestamp() if activity.timestamps.start else None,
-                    'end': activity.timestamps.end.timestamp() if activity.timestamps.end else None
-                }
+        # Coalesce bursts per user; the member is serialized at flush time
+        self._pending_presence[after.id] = after
+    
+    async def _flush_presence_updates(self):
+        """Publish coalesced presence updates every PRESENCE_FLUSH_INTERVAL"""
+        while True:
+            await asyncio.sleep(config.PRESENCE_FLUSH_INTERVAL)
+            if not self._pending_presence:
+                continue
+            pending, self._pending_presence = self._pending_presence, {}
             
-            presence_data['activities'].append(activity_data)
+            # One thread hop for the whole batch, then publish concurrently
+            try:
+                presences = await asyncio.to_thread(_build_presence_dicts, list(pending.values()))
+            except Exception as e:
+                logger.error(f"Failed to build {len(pending)} presences: {e}")
+                continue
+            results = await asyncio.gather(
+                *(self._publish_presence(user_id, presence_data)
+                  for user_id, presence_data in zip(pending, presences) if presence_data is not None),
+                return_exceptions=True
+            )
+            for result in results:
+                if isinstance(result, Exception):
+                    logger.error(f"Failed to publish presence: {result}")
+    
+    async def _publish_presence(self, user_id: int, presence_data: Dict[str, Any]):
+        # Skip unchanged presences (lastSeen is excluded from the fingerprint)
+        presence_hash = xxhash.xxh64_intdigest(orjson.dumps(presence_data, default=str))
+        now = time.monotonic()
+        last = self._last_hash.get(user_id)
+        changed = last is None or last[0] != presence_hash
+        # An unchanged presence is only rewritten once its cache entry is half way to expiry
+        if not changed and now - last[1] < cache.ttl_for((b'presence', user_id)) / 2:
+            return
+        self._last_hash[user_id] = (presence_hash, now)
+        self._last_hash.move_to_end(user_id)
+        if len(self._last_hash) > config.PRESENCE_HASH_MAX:
+            self._last_hash.popitem(last=False)
         
-        await cache.set_cache(f"presence:{after.id}", presence_data)
+        presence_data['lastSeen'] = time.time()
         
-        # Send to WebSocket clients
-        if self.sio:
-            await self.sio.emit('presenceUpdate', presence_data)
+        await cache.set_cache(b'presence', user_id, presence_data)
+        
+        # Send to clients subscribed to this user
+        if self.sio and changed:
+            await self.sio.emit('presenceUpdate', presence_data, room=f"user_{user_id}")
     
     async def on_member_update(self, before, after):
         if before.display_name != after.display_name or before.avatar != after.avatar:
-            user_data = {
-                'id': str(after.id),
-                'username': after.name,
-                'global_name': after.global_name if hasattr(after, 'global_name') else after.display_name,
-                'display_name': after.display_name,
-                'avatar': str(after.avatar) if after.avatar else None,
-                'discriminator': after.discriminator,
-                'public_flags': after.public_flags.value if after.public_flags else 0,
-                'banner': str(after.banner) if after.banner else None,
-                'accent_color': after.accent_color.value if after.accent_color else None,
-                'bot': after.bot,
-                'avatar_decoration_data': getattr(after, 'avatar_decoration_data', None),
-                'collectibles': getattr(after, 'collectibles', None),
-                'primary_guild': getattr(after, 'primary_guild', None),
-                'display_name_styles': getattr(after, 'display_name_styles', None)
-            }
+            user_data = _serialize_user(after)
             
-            await cache.set_cache(f"user:{after.id}", user_data)
+            await cache.set_cache(b'user', after.id, user_data)
             
             if self.sio:
-                await self.sio.emit('userUpdate', user_data)
+                await self.sio.emit('userUpdate', user_data, room=f"user_{after.id}")
 
 bot = DiscordBot()
 
-# Socket.IO setup
-sio = socketio.AsyncServer(cors_allowed_origins=config.CORS_ORIGIN)
-app = FastAPI(title="Discord Presence API", version="1.0.0")
+# Socket.IO setup (Redis manager shares rooms and emits across workers)
+class _OrjsonCodec:
+    """json-module shim so Socket.IO packets are encoded with orjson"""
+    @staticmethod
+    def dumps(obj, *args, **kwargs) -> str:
+        return orjson.dumps(obj, default=str).decode()
+    
+    @staticmethod
+    def loads(data, *args, **kwargs):
+        return orjson.loads(data)
+
+sio_manager = socketio.AsyncRedisManager(config.REDIS_URL) if config.REDIS_URL else None
+sio = socketio.AsyncServer(
+    async_mode='asgi',
+    cors_allowed_origins=config.CORS_ORIGIN,
+    client_manager=sio_manager,
+    transports=config.SOCKETIO_TRANSPORTS,
+    async_handlers=True,
+    json=_OrjsonCodec
+)
+app = FastAPI(title="Discord Presence API", version="1.0.0", default_response_class=ORJSONResponse)
 
 # Mount Socket.IO
 sio_app = socketio.ASGIApp(sio, app)
@@ -224,7 +657,27 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Formatted once per second so /ping and /health don't build a datetime per call
+def _utc_now_iso() -> str:
+    return datetime.now(timezone.utc).isoformat(timespec='seconds').replace('+00:00', 'Z')
+
+_now_iso = _utc_now_iso()
+
+async def _tick_clock():
+    global _now_iso
+    while True:
+        _now_iso = _utc_now_iso()
+        await asyncio.sleep(1)
+
 # API Routes
+router = APIRouter(prefix=f"/{config.API_VERSION}")
+
+def _parse_user_id(user_id: str) -> Optional[int]:
+    """Parse a snowflake path parameter (ASCII digits, at most 20), None if invalid"""
+    if user_id.isascii() and user_id.isdigit() and len(user_id) <= 20:
+        return int(user_id)
+    return None
+
 @app.get("/")
 async def root():
     return {
@@ -236,14 +689,15 @@ async def root():
         "github": "https://github.com/imnotemjay/"
     }
 
-@app.get(f"/{config.API_VERSION}/health")
+@router.get("/health")
 async def health_check():
+    gateway_ready = bot.ready or _bot_ready_elsewhere
     return {
         "status": "healthy",
-        "timestamp": datetime.now().isoformat(),
+        "timestamp": _now_iso,
         "discord": {
-            "status": "connected" if bot.ready else "disconnected",
-            "ready": bot.ready,
+            "status": "connected" if gateway_ready else "disconnected",
+            "ready": gateway_ready,
             "guilds": len(bot.guilds) if bot.ready else 0
         },
         "redis": {
@@ -255,7 +709,7 @@ async def health_check():
 @app.get("/ping")
 async def ping():
     """Simple ping endpoint for uptime monitoring services like UptimeRobot"""
-    return {"status": "ok", "timestamp": datetime.now().isoformat()}
+    return {"status": "ok", "timestamp": _now_iso}
 
 @app.get("/debug")
 async def debug():
@@ -284,55 +738,51 @@ async def debug():
 @app.post("/restart-bot")
 async def restart_bot():
     """Manually restart the Discord bot"""
+    global _bot_start_task
     try:
-        if bot.is_ready():
-            await bot.close()
+        # With several workers only the lock holder may open the gateway
+        if _election_task and not _bot_owner:
+            return {"status": "error", "message": "Discord bot runs in another worker"}
+        
+        if _bot_start_task:
+            _bot_start_task.cancel()
+        if bot.is_ready() or bot.rest_ready:
+            await close_discord_bot()
             logger.info("Bot closed for restart")
         
         # Start bot again
-        asyncio.create_task(start_discord_bot())
+        _bot_start_task = asyncio.create_task(start_discord_bot())
         return {"status": "success", "message": "Bot restart initiated"}
     except Exception as e:
         return {"status": "error", "message": str(e)}
 
-@app.get(f"/{config.API_VERSION}/users/{{user_id}}")
+@router.get("/users/{user_id}")
 async def get_user(user_id: str):
     """Get user profile + presence data (Lanyard style)"""
+    uid = _parse_user_id(user_id)
+    if uid is None:
+        return {
+            "success": False,
+            "error": {
+                "code": 404,
+                "message": "User not found"
+            }
+        }
+    
     try:
-        user_data = None
-        presence_data = None
-        
-        # Get cached data
-        cached_user = await cache.get_cache(f"user:{user_id}")
-        if cached_user:
-            user_data = cached_user
-        
-        cached_presence = await cache.get_cache(f"presence:{user_id}")
-        if cached_presence:
-            presence_data = cached_presence
+        # Get cached data, both reads in one round of awaits
+        user_data, presence_data = await asyncio.gather(
+            cache.get_cache(b'user', uid),
+            cache.get_cache(b'presence', uid)
+        )
         
-        # Fetch fresh data if bot is ready
-        if bot.ready and not user_data:
+        # Fetch fresh data if the bot is logged in (REST works without the gateway)
+        if bot.rest_ready and not user_data:
             try:
-                discord_user = await bot.fetch_user(int(user_id))
-                user_data = {
-                    'id': str(discord_user.id),
-                    'username': discord_user.name,
-                    'global_name': discord_user.global_name if hasattr(discord_user, 'global_name') else discord_user.display_name,
-                    'display_name': discord_user.display_name,
-                    'avatar': str(discord_user.avatar) if discord_user.avatar else None,
-                    'discriminator': discord_user.discriminator,
-                    'public_flags': discord_user.public_flags.value if discord_user.public_flags else 0,
-                    'banner': str(discord_user.banner) if discord_user.banner else None,
-                    'accent_color': discord_user.accent_color.value if discord_user.accent_color else None,
-                    'bot': discord_user.bot,
-                    'avatar_decoration_data': getattr(discord_user, 'avatar_decoration_data', None),
-                    'collectibles': getattr(discord_user, 'collectibles', None),
-                    'primary_guild': getattr(discord_user, 'primary_guild', None),
-                    'display_name_styles': getattr(discord_user, 'display_name_styles', None)
-                }
+                discord_user = await bot.fetch_user_once(uid)
+                user_data = _serialize_user(discord_user)
                 
-                await cache.set_cache(f"user:{user_id}", user_data)
+                await cache.set_cache(b'user', uid, user_data)
             except discord.NotFound:
                 return {
                     "success": False,
@@ -353,90 +803,11 @@ async def get_user(user_id: str):
         # Get presence data if needed
         if bot.ready and not presence_data:
             try:
-                for guild in bot.guilds:
-                    try:
-                        member = await guild.fetch_member(int(user_id))
-                        if member.presence:
-                            presence_data = {
-                                'discord_status': str(member.presence.status),
-                                'active_on_discord_desktop': member.presence.desktop,
-                                'active_on_discord_mobile': member.presence.mobile,
-                                'active_on_discord_web': member.presence.web,
-                                'active_on_discord_embedded': False,
-                                'listening_to_spotify': any(a.name == 'Spotify' for a in member.presence.activities),
-                                'activities': [],
-                                'spotify': None
-                            }
-                            
-                            # Format activities
-                            for activity in member.presence.activities:
-                                activity_data = {
-                                    'type': activity.type.value,
-                                    'name': activity.name,
-                                    'details': getattr(activity, 'details', None),
-                                    'state': getattr(activity, 'state', None),
-                                    'application_id': str(activity.application_id) if activity.application_id else None,
-                                    'id': str(activity.id) if activity.id else None,
-                                    'flags': getattr(activity, 'flags', 0),
-                                    'created_at': getattr(activity, 'created_at', None),
-                                    'sync_id': getattr(activity, 'sync_id', None),
-                                    'session_id': getattr(activity, 'session_id', None)
-                                }
-                                
-                                # Add party info if available
-                                if hasattr(activity, 'party') and activity.party:
-                                    activity_data['party'] = {
-                                        'id': activity.party.id if activity.party.id else None,
-                                        'size': getattr(activity.party, 'size', None),
-                                        'max': getattr(activity.party, 'max', None)
-                                    }
-                                
-                                if activity.assets:
-                                    activity_data['assets'] = {
-                                        'large_image': activity.assets.large_image,
-                                        'large_text': activity.assets.large_text,
-                                        'small_image': activity.assets.small_image,
-                                        'small_text': activity.assets.small_text
-                                    }
-                                
-                                if activity.timestamps:
-                                    activity_data['timestamps'] = {
-                                        'start': activity.timestamps.start.timestamp() if activity.timestamps.start else None,
-                                        'end': activity.timestamps.end.timestamp() if activity.timestamps.end else None
-                                    }
-                                
-                                presence_data['activities'].append(activity_data)
-                            
-                            # Handle Spotify
-                            if presence_data['listening_to_spotify']:
-                                spotify_activity = next((a for a in member.presence.activities if a.name == 'Spotify'), None)
-                                if spotify_activity:
-                                    # Extract album art from assets
-                                    album_art_url = None
-                                    if spotify_activity.assets:
-                                        if spotify_activity.assets.large_image:
-                                            if spotify_activity.assets.large_image.startswith('spotify:'):
-                                                album_art_url = f"https://i.scdn.co/image/{spotify_activity.assets.large_image.replace('spotify:', '')}"
-                                            else:
-                                                album_art_url = f"https://cdn.discordapp.com/app-assets/{spotify_activity.application_id}/{spotify_activity.assets.large_image}.png"
-                                    
-                                    presence_data['spotify'] = {
-                                        'track_id': spotify_activity.sync_id,
-                                        'timestamps': {
-                                            'start': spotify_activity.timestamps.start.timestamp() if spotify_activity.timestamps.start else None,
-                                            'end': spotify_activity.timestamps.end.timestamp() if spotify_activity.timestamps.end else None
-                                        },
-                                        'song': spotify_activity.details,
-                                        'artist': spotify_activity.state,
-                                        'album_art_url': album_art_url,
-                                        'album': spotify_activity.assets.large_text if spotify_activity.assets and spotify_activity.assets.large_text else None
-                                    }
-                            
-                            await cache.set_cache(f"presence:{user_id}", presence_data)
-                            break
-                    except (discord.NotFound, discord.Forbidden):
-                        continue
-                        
+                member = await bot.find_member(uid)
+                if member:
+                    presence_data = await asyncio.to_thread(_build_presence_dict, member)
+                    
+                    await cache.set_cache(b'presence', uid, presence_data)
             except Exception:
                 pass
         
@@ -476,17 +847,28 @@ async def get_user(user_id: str):
             }
         }
 
-@app.get(f"/{config.API_VERSION}/presence/{{user_id}}")
+@router.get("/presence/{user_id}")
 async def get_presence(user_id: str, guild_id: Optional[str] = None):
     """Get user presence data only"""
     try:
-        cached_presence = await cache.get_cache(f"presence:{user_id}")
+        uid = _parse_user_id(user_id)
+        cached_presence = await cache.get_cache(b'presence', uid) if uid else None
         if cached_presence:
             return {
                 "success": True,
                 "data": cached_presence
             }
         
+        # Presence entries expire quickly, rebuild from the member cache
+        member = bot.get_cached_member(uid) if bot.ready and uid else None
+        if member:
+            presence_data = await asyncio.to_thread(_build_presence_dict, member)
+            await cache.set_cache(b'presence', uid, presence_data)
+            return {
+                "success": True,
+                "data": presence_data
+            }
+        
         # Return offline presence if no data
         offline_presence = {
             'userId': user_id,
@@ -516,11 +898,18 @@ async def get_presence(user_id: str, guild_id: Optional[str] = None):
             }
         }
 
-@app.get(f"/{config.API_VERSION}/guilds")
+@router.get("/guilds")
 async def get_guilds():
     """Get bot guilds"""
     try:
         if not bot.ready:
+            # The worker holding the gateway connection shares the list through Redis
+            guilds_data = await cache.get_cache(b'guilds', 0)
+            if guilds_data:
+                return {
+                    "success": True,
+                    "data": guilds_data
+                }
             return {
                 "success": False,
                 "error": {
@@ -529,25 +918,10 @@ async def get_guilds():
                 }
             }
         
-        guilds_data = []
-        for guild in bot.guilds:
-            guild_data = {
-                'id': str(guild.id),
-                'name': guild.name,
-                'icon': str(guild.icon) if guild.icon else None,
-                'memberCount': guild.member_count,
-                'ownerId': str(guild.owner_id) if guild.owner else None,
-                'features': list(guild.features)
-            }
-            guilds_data.append(guild_data)
+        if bot.guilds_cache is None:
+            bot.build_guilds_cache()
         
-        return {
-            "success": True,
-            "data": {
-                'guilds': guilds_data,
-                'total': len(guilds_data)
-            }
-        }
+        return Response(content=bot.guilds_cache, media_type='application/json')
         
     except Exception as e:
         logger.error(f"Error fetching guilds: {e}")
@@ -559,25 +933,51 @@ async def get_guilds():
             }
         }
 
+app.include_router(router)
+
 # Socket.IO events
+async def _subscribe(sid, user_id):
+    await sio.enter_room(sid, f"user_{user_id}")
+    logger.info(f"Client {sid} subscribed to user {user_id}")
+
 @sio.event
-async def connect(sid, environ):
+async def connect(sid, environ, auth=None):
     logger.info(f"Client connected: {sid}")
+    
+    # Clients can subscribe in the handshake to skip the subscribe_user round-trip
+    user_id = auth.get('user_id') if isinstance(auth, dict) else None
+    if user_id:
+        await _subscribe(sid, user_id)
 
 @sio.event
 async def subscribe_user(sid, data):
     user_id = data.get('user_id')
     if user_id:
-        await sio.enter_room(sid, f"user_{user_id}")
-        logger.info(f"Client {sid} subscribed to user {user_id}")
+        await _subscribe(sid, user_id)
 
 @sio.event
 async def disconnect(sid):
     logger.info(f"Client disconnected: {sid}")
 
 # Startup and shutdown
+_clock_task = None
+_election_task = None
+
+# With several workers sharing Redis, only the holder of this lock runs the gateway connection;
+# it refreshes the heartbeat key while the bot is ready
+_BOT_LOCK_KEY = 'discord:bot_owner'
+_BOT_HEARTBEAT_KEY = 'discord:bot_ready'
+_BOT_LOCK_TOKEN = uuid.uuid4().hex
+_RENEW_BOT_LOCK = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('expire', KEYS[1], ARGV[2]) end return 0"
+_RELEASE_BOT_LOCK = "if redis.call('get', KEYS[1]) == ARGV[1] then return redis.call('del', KEYS[1]) end return 0"
+_bot_owner = False
+_bot_ready_elsewhere = False
+_bot_start_task = None
+
 @app.on_event("startup")
 async def startup_event():
+    global _clock_task, _election_task, _bot_start_task
+    _clock_task = asyncio.create_task(_tick_clock())
     await cache.connect_redis()
     
     # Start Discord bot in background if not disabled
@@ -586,11 +986,66 @@ async def startup_event():
     else:
         try:
             bot.sio = sio
-            asyncio.create_task(start_discord_bot())
+            if cache.redis_client:
+                _election_task = asyncio.create_task(elect_discord_bot())
+            else:
+                _bot_start_task = asyncio.create_task(start_discord_bot())
             logger.info("Discord bot startup initiated...")
         except Exception as e:
             logger.error(f"Failed to initiate Discord bot startup: {e}")
 
+async def login_discord_bot():
+    """Log in for REST calls; the gateway connection is opened separately"""
+    if not bot.rest_ready:
+        await bot.login(config.DISCORD_BOT_TOKEN)
+        bot.rest_ready = True
+
+async def close_discord_bot():
+    """Close the bot so it can log in again later"""
+    bot.ready = False
+    bot.rest_ready = False
+    await bot.close()
+    # close() also closes the HTTP connector and clear() doesn't replace it;
+    # MISSING makes the next login build a fresh one
+    bot.http.connector = discord.utils.MISSING
+    bot.clear()
+
+async def elect_discord_bot():
+    """Run the Discord bot in whichever worker holds the Redis owner lock"""
+    global _bot_owner, _bot_ready_elsewhere, _bot_start_task
+    while True:
+        try:
+            if _bot_owner:
+                _bot_owner = bool(await cache.redis_client.eval(
+                    _RENEW_BOT_LOCK, 1, _BOT_LOCK_KEY, _BOT_LOCK_TOKEN, config.BOT_LOCK_TTL
+                ))
+                if _bot_owner and bot.ready:
+                    await cache.redis_client.set(_BOT_HEARTBEAT_KEY, _BOT_LOCK_TOKEN, ex=config.BOT_LOCK_TTL)
+                    # Workers without the gateway serve /guilds from the shared copy
+                    await bot.share_guilds()
+                elif not _bot_owner:
+                    logger.warning("Lost the Discord bot lock, closing the gateway connection")
+                    if _bot_start_task:
+                        _bot_start_task.cancel()
+                    await close_discord_bot()
+                    await cache.redis_client.eval(_RELEASE_BOT_LOCK, 1, _BOT_HEARTBEAT_KEY, _BOT_LOCK_TOKEN)
+            else:
+                _bot_owner = bool(await cache.redis_client.set(
+                    _BOT_LOCK_KEY, _BOT_LOCK_TOKEN, nx=True, ex=config.BOT_LOCK_TTL
+                ))
+                if _bot_owner:
+                    logger.info("Acquired the Discord bot lock, starting the gateway connection")
+                    _bot_start_task = asyncio.create_task(start_discord_bot())
+                else:
+                    # Serve REST fallbacks while another worker runs the gateway
+                    await login_discord_bot()
+            _bot_ready_elsewhere = not _bot_owner and bool(await cache.redis_client.exists(_BOT_HEARTBEAT_KEY))
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.warning(f"Discord bot lock check failed: {e}")
+        await asyncio.sleep(config.BOT_LOCK_TTL / 3)
+
 async def start_discord_bot():
     """Start Discord bot with aggressive retry logic for rate limits"""
     import random
@@ -607,7 +1062,8 @@ async def start_discord_bot():
                 logger.info(f"Retrying Discord bot connection in {delay:.1f}s (attempt {attempt + 1}/{max_retries})")
                 await asyncio.sleep(delay)
             
-            await bot.start(config.DISCORD_BOT_TOKEN)
+            await login_discord_bot()
+            await bot.connect()
             return  # Success, exit function
             
         except discord.LoginFailure:
@@ -642,10 +1098,18 @@ async def start_discord_bot():
 
 @app.on_event("shutdown")
 async def shutdown_event():
-    if bot.is_ready():
+    if _election_task:
+        _election_task.cancel()
+    if bot.is_ready() or bot.rest_ready:
         await bot.close()
-    if cache.redis_client:
-        await cache.redis_client.close()
+    if _bot_owner and cache.redis_client:
+        # Hand the gateway to another worker without waiting for the lock to expire
+        try:
+            await cache.redis_client.eval(_RELEASE_BOT_LOCK, 1, _BOT_HEARTBEAT_KEY, _BOT_LOCK_TOKEN)
+            await cache.redis_client.eval(_RELEASE_BOT_LOCK, 1, _BOT_LOCK_KEY, _BOT_LOCK_TOKEN)
+        except Exception as e:
+            logger.warning(f"Failed to release the Discord bot lock: {e}")
+    await cache.close()
 
 # Run server
 if __name__ == "__main__":
@@ -653,12 +1117,23 @@ if __name__ == "__main__":
     signal.signal(signal.SIGINT, lambda s, f: signal_handler())
     signal.signal(signal.SIGTERM, lambda s, f: signal_handler())
     
+    # asyncio.run below creates the loop itself, so install uvloop up front;
+    # fall back to the default loop where it isn't available (e.g. Windows)
+    try:
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+        loop_impl = "uvloop"
+    except ImportError:
+        loop_impl = "asyncio"
+    
     # Create server instance
     uvicorn_config = uvicorn.Config(
         sio_app,
         host=config.HOST,
         port=config.PORT,
         reload=config.DEBUG,
+        loop=loop_impl,
+        http="httptools",
         log_level="info"
     )
     server = uvicorn.Server(uvicorn_config)